@@ -1,11 +1,20 @@
 import argparse
+import logging
 import os
-from prometheus_client import start_http_server, Gauge, Info
+from prometheus_client import start_http_server, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 import telnetlib3
 import asyncio
+import threading
 import time
 import re
 
+try:
+    # google-re2 guarantees linear-time matching on unexpected device output
+    import re2 as regex_engine
+except ImportError:
+    regex_engine = re
+
 parser = argparse.ArgumentParser(description='GPON Metrics Collector')
 parser.add_argument('--hostname', action='append',
                     help='Hostname or IP of the GPON device (env: GPON_HOSTNAMES, comma-separated)')
@@ -21,9 +30,32 @@ parser.add_argument('--webserver-port', type=int,
 parser.add_argument('--fetch-interval', type=int,
                     default=int(os.getenv('GPON_FETCH_INTERVAL', '60')),
                     help='Interval (in seconds) between metric fetches (env: GPON_FETCH_INTERVAL)')
+parser.add_argument('--connect-timeout', type=float,
+                    default=float(os.getenv('GPON_CONNECT_TIMEOUT', '10')),
+                    help='Timeout (in seconds) for connecting and for each login step (env: GPON_CONNECT_TIMEOUT)')
+parser.add_argument('--command-timeout', type=float,
+                    default=float(os.getenv('GPON_COMMAND_TIMEOUT', '10')),
+                    help='Timeout (in seconds) for a device to answer each command (env: GPON_COMMAND_TIMEOUT)')
+parser.add_argument('--max-concurrent', type=int,
+                    default=int(os.getenv('GPON_MAX_CONCURRENT', '32')),
+                    help='Maximum number of devices polled at the same time (env: GPON_MAX_CONCURRENT)')
+parser.add_argument('--log-level',
+                    default=os.getenv('GPON_LOG_LEVEL', 'INFO'),
+                    help='Logging level, e.g. DEBUG, INFO or WARNING (env: GPON_LOG_LEVEL)')
 
 args = parser.parse_args()
 
+if args.connect_timeout <= 0 or args.command_timeout <= 0:
+    parser.error('--connect-timeout and --command-timeout must be positive')
+if args.max_concurrent < 1:
+    parser.error('--max-concurrent must be at least 1')
+if not isinstance(logging.getLevelName(args.log_level.upper()), int):
+    parser.error(f'Invalid log level: {args.log_level}')
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('gpon')
+logger.setLevel(args.log_level.upper())
+
 
 # Handle environment variables for list arguments
 def parse_env_list(env_var, arg_list, convert_func=str, default_value=None):
@@ -60,61 +92,134 @@ list_lengths = [len(args.hostname), len(args.port), len(args.user), len(args.pas
 if len(set(list_lengths)) != 1:
     parser.error('All device configuration lists (hostname, port, user, password) must have the same length')
 
-temperature_gauge = Gauge('gpon_temperature_celsius', 'Temperature of the GPON device in Celsius', ['ip'])
-voltage_gauge = Gauge('gpon_voltage_volts', 'Voltage of the GPON device in Volts', ['ip'])
-tx_power_gauge = Gauge('gpon_tx_power_dbm', 'Tx Power of the GPON device in dBm', ['ip'])
-rx_power_gauge = Gauge('gpon_rx_power_dbm', 'Rx Power of the GPON device in dBm', ['ip'])
-bias_current_gauge = Gauge('gpon_bias_current_mA', 'Bias Current of the GPON device in mA', ['ip'])
-onu_state_gauge = Gauge('gpon_onu_state', 'ONU State of the GPON device', ['ip'])
-
+# Devices report states as 1, 01 or O1 (letter O) depending on firmware
 onu_state_mapping = {
-    '01': 1,
-    '02': 2,
-    '03': 3,
-    '04': 4,
-    'O5': 5,
-    '06': 6,
-    '07': 7,
+    code: state
+    for state in range(1, 8)
+    for code in (str(state), f'0{state}', f'O{state}')
+}
+
+_SIGNED_FLOAT_RE = regex_engine.compile(r'(-?\d+\.\d+)')
+_UNSIGNED_FLOAT_RE = regex_engine.compile(r'(\d+\.\d+)')
+_ONU_STATE_RE = regex_engine.compile(r'ONU state:\s*([A-Za-z0-9]+)')
+_PROMPT_RE = re.compile(rb'[$#>] ?\Z')
+_ERROR_RESPONSE_RE = re.compile(r'(?i)error|invalid')
+_LOGIN_PROMPT_RE = re.compile(rb'(?i)(?:login|username|password): ?\Z')
+
+
+def parse_onu_state(code):
+    """Map a reported ONU state code to its numeric state, or None if unknown"""
+    return onu_state_mapping.get(code.upper())
+
+
+# Metric name, description, pattern and converter for each diagnostic command
+commands = {
+    'diag pon get transceiver bias-current': (
+        'gpon_bias_current_mA', 'Bias Current of the GPON device in mA', _UNSIGNED_FLOAT_RE, float),
+    'diag pon get transceiver rx-power': (
+        'gpon_rx_power_dbm', 'Rx Power of the GPON device in dBm', _SIGNED_FLOAT_RE, float),
+    'diag pon get transceiver temperature': (
+        'gpon_temperature_celsius', 'Temperature of the GPON device in Celsius', _UNSIGNED_FLOAT_RE, float),
+    'diag pon get transceiver tx-power': (
+        'gpon_tx_power_dbm', 'Tx Power of the GPON device in dBm', _SIGNED_FLOAT_RE, float),
+    'diag pon get transceiver voltage': (
+        'gpon_voltage_volts', 'Voltage of the GPON device in Volts', _UNSIGNED_FLOAT_RE, float),
+    'diag gpon get onu-state': (
+        'gpon_onu_state', 'ONU State of the GPON device', _ONU_STATE_RE, parse_onu_state),
 }
 
+# Latest readings published by the collector loop, keyed by (command, hostname)
+_SNAPSHOT = {}
+_SNAPSHOT_LOCK = threading.Lock()
+
+# Per-device collection health, guarded by the same lock as the readings
+_COLLECTION_DURATIONS = {}
+_COLLECTION_ERRORS = {hostname: 0 for hostname in args.hostname}
+_COMMAND_ERRORS = {}
+
+
+class GponCollector:
+    """Expose the latest readings of every device in a single registry walk"""
+
+    def collect(self):
+        with _SNAPSHOT_LOCK:
+            snapshot = dict(_SNAPSHOT)
+            durations = dict(_COLLECTION_DURATIONS)
+            errors = dict(_COLLECTION_ERRORS)
+            command_errors = dict(_COMMAND_ERRORS)
+
+        families = {
+            command: GaugeMetricFamily(name, documentation, labels=['ip'])
+            for command, (name, documentation, _, _) in commands.items()
+        }
+        for (command, hostname), value in snapshot.items():
+            families[command].add_metric([hostname], value)
+        yield from families.values()
 
-async def wait_for_prompt(reader, timeout=60):
+        duration = GaugeMetricFamily('gpon_collection_duration_seconds',
+                                     'Time taken by the last metric collection from the GPON device', labels=['ip'])
+        for hostname, value in durations.items():
+            duration.add_metric([hostname], value)
+        yield duration
+
+        failures = CounterMetricFamily('gpon_collection_errors',
+                                       'Failed metric collections from the GPON device', labels=['ip'])
+        for hostname, value in errors.items():
+            failures.add_metric([hostname], value)
+        yield failures
+
+        command_failures = CounterMetricFamily('gpon_command_errors',
+                                               'Diagnostic commands that returned no output or an error',
+                                               labels=['ip', 'command'])
+        for (command, hostname), value in command_errors.items():
+            command_failures.add_metric([hostname, command], value)
+        yield command_failures
+
+
+REGISTRY.register(GponCollector())
+
+
+async def wait_for_prompt(reader, timeout=60, prompt_re=_PROMPT_RE):
     """Wait for a command prompt (typically ending with $, #, or >)"""
     try:
-        buffer = ""
-        start_time = time.time()
+        buffer = bytearray()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
 
-        while time.time() - start_time < timeout:
-            try:
-                chunk = await asyncio.wait_for(reader.read(1024), timeout=1)
-                if not chunk:
-                    break
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
 
-                # Ensure chunk is a string
-                if isinstance(chunk, bytes):
-                    chunk = chunk.decode('utf-8', errors='ignore')
+            # Sleep until data arrives instead of waking up every second
+            try:
+                chunk = await asyncio.wait_for(reader.read(1024), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
 
-                buffer += chunk
+            # Match on raw bytes and decode only once the response is complete
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8', errors='ignore')
 
-                # Check if we have a prompt-like ending
-                if buffer.endswith('$ ') or buffer.endswith('# ') or buffer.endswith('> ') or \
-                        buffer.endswith('$') or buffer.endswith('#') or buffer.endswith('>'):
-                    return buffer
+            buffer.extend(chunk)
 
-            except asyncio.TimeoutError:
-                continue
+            # Check if we have a prompt-like ending
+            if prompt_re.search(buffer[-16:]):
+                break
 
-        return buffer
+        return buffer.decode('utf-8', errors='ignore')
 
     except Exception as e:
-        print(f"Error waiting for prompt: {e}")
+        logger.warning("Error waiting for prompt: %s", e)
         return ""
 
 
-async def execute_telnet_command(reader, writer, command, timeout=30):
+async def execute_telnet_command(reader, writer, command, timeout=args.command_timeout):
     """Execute a command via telnet and return the response"""
     try:
-        writer.write(command + '\r\n')
+        writer.write(command.encode() + b'\r\n')
         await writer.drain()
 
         # Wait for response
@@ -122,110 +227,296 @@ async def execute_telnet_command(reader, writer, command, timeout=30):
         return response
 
     except Exception as e:
-        print(f"Error executing command '{command}': {e}")
+        logger.warning("Error executing command '%s': %s", command, e)
         return ""
 
 
-async def fetch_and_update_metrics_via_telnet(hostname, port, username, password):
-    """Connect via telnet and fetch metrics"""
-    try:
-        print(f"Connecting to {hostname}:{port}")
+async def read_until_prompts(reader, prompt, count, timeout):
+    """Read until the device prompt has been seen count times and return the transcript"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    transcript = ""
+
+    while transcript.count(prompt) < count:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        response = await wait_for_prompt(reader, remaining)
+        if not response:
+            break
+        transcript += response
+
+    return transcript
+
+
+class DeviceSession:
+    """Long-lived telnet session to a single GPON device"""
+
+    def __init__(self, hostname, port, username, password):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.reader = None
+        self.writer = None
+        self.prompt = None
+        self.pipelining = True
+        # Snapshot key, pattern and converter for each command, in command order
+        self.steps = [
+            ((command, hostname), pattern, convert)
+            for command, (_, _, pattern, convert) in commands.items()
+        ]
+        self.last_values = {}
+
+    async def ensure_connected(self):
+        """Connect and log in unless a session is already open"""
+        if self.writer is not None:
+            # Devices log out idle sessions, so only reuse one that is still open
+            if not self.reader.at_eof():
+                return True
+            self.close()
+
+        logger.info("Connecting to %s:%s", self.hostname, self.port)
 
         # Connect to telnet server
         reader, writer = await asyncio.wait_for(
-            telnetlib3.open_connection(hostname, port),
-            timeout=15
+            telnetlib3.open_connection(self.hostname, self.port, encoding=False),
+            timeout=args.connect_timeout
         )
 
-        # Wait for initial connection response
-        initial_response = await wait_for_prompt(reader, timeout=10)
-        print(f"Initial response from {hostname}: {initial_response[:100]}...")
-
-        # Send username
-        if 'login:' in initial_response.lower() or 'username:' in initial_response.lower():
-            writer.write(username + '\r\n')
-            await writer.drain()
+        try:
+            # Wait for initial connection response
+            initial_response = await wait_for_prompt(reader, args.connect_timeout, _LOGIN_PROMPT_RE)
+            logger.debug("Initial response from %s: %.100s...", self.hostname, initial_response)
 
-            # Wait for password prompt
-            password_response = await wait_for_prompt(reader, timeout=10)
-            print(f"Password prompt from {hostname}: {password_response[:100]}...")
-
-            if 'password:' in password_response.lower():
-                writer.write(password + '\r\n')
+            # Send username
+            if 'login:' in initial_response.lower() or 'username:' in initial_response.lower():
+                writer.write(self.username.encode() + b'\r\n')
                 await writer.drain()
 
-                # Wait for shell prompt
-                shell_response = await wait_for_prompt(reader, timeout=10)
-                print(f"Shell prompt from {hostname}: {shell_response[:100]}...")
+                # Wait for password prompt
+                password_response = await wait_for_prompt(reader, args.connect_timeout, _LOGIN_PROMPT_RE)
+                logger.debug("Password prompt from %s: %.100s...", self.hostname, password_response)
+
+                if 'password:' in password_response.lower():
+                    writer.write(self.password.encode() + b'\r\n')
+                    await writer.drain()
+
+                    # Wait for shell prompt
+                    shell_response = await wait_for_prompt(reader, args.connect_timeout)
+                    logger.debug("Shell prompt from %s: %.100s...", self.hostname, shell_response)
+                else:
+                    logger.warning("No password prompt received from %s", self.hostname)
+                    writer.close()
+                    return False
             else:
-                print(f"No password prompt received from {hostname}")
+                logger.warning("No login prompt received from %s", self.hostname)
                 writer.close()
-                return
-        else:
-            print(f"No login prompt received from {hostname}")
+                return False
+
+            # Remember the shell prompt so pipelined output can be split per command
+            prompt = shell_response.rsplit('\n', 1)[-1].strip()
+            self.prompt = prompt if _PROMPT_RE.search(prompt.encode()) else None
+        except BaseException:
+            # Don't leak the connection if login fails or the collection budget cancels it
             writer.close()
-            return
-
-        commands = {
-            'diag pon get transceiver bias-current': bias_current_gauge,
-            'diag pon get transceiver rx-power': rx_power_gauge,
-            'diag pon get transceiver temperature': temperature_gauge,
-            'diag pon get transceiver tx-power': tx_power_gauge,
-            'diag pon get transceiver voltage': voltage_gauge,
-            'diag gpon get onu-state': onu_state_gauge,
-        }
+            raise
+
+        self.reader, self.writer = reader, writer
+        return True
+
+    async def run_serial(self):
+        """Send the commands one at a time, waiting for the prompt after each"""
+        results = []
+        for command in commands:
+            logger.debug("Executing command on %s: %s", self.hostname, command)
+            results.append(await execute_telnet_command(self.reader, self.writer, command))
+        return results
+
+    async def run_pipelined(self, timeout):
+        """Send all commands at once and split the transcript on the shell prompt
+
+        Returns None if the device did not answer every command.
+        """
+        logger.debug("Executing %d pipelined commands on %s", len(commands), self.hostname)
+        # Count the round as a pipelining failure unless it completes, so a read
+        # cancelled by the collection budget also switches the device to serial mode
+        self.pipelining = False
+        self.writer.write(('\r\n'.join(commands) + '\r\n').encode())
+        await self.writer.drain()
+
+        transcript = await read_until_prompts(self.reader, self.prompt, len(commands), timeout)
+        segments = transcript.split(self.prompt)
+        if len(segments) <= len(commands):
+            # A dropped connection says nothing about pipelining support, just reconnect
+            if self.reader.at_eof():
+                self.pipelining = True
+                raise ConnectionResetError('connection closed by device')
+            logger.warning("%s did not answer pipelined commands, switching to serial mode", self.hostname)
+            return None
+
+        self.pipelining = True
+        return segments[:len(commands)]
+
+    async def poll(self, deadline):
+        """Run the diagnostic commands on the open session and publish the readings"""
+        results = None
+        if self.pipelining and self.prompt:
+            # Keep half of the remaining budget for the serial fallback
+            remaining = deadline - asyncio.get_running_loop().time()
+            results = await self.run_pipelined(min(len(commands) * args.command_timeout, remaining / 2))
+            if results is None:
+                # Unanswered commands would desync the session, so fall back on a fresh one
+                self.close()
+                if not await self.ensure_connected():
+                    raise ConnectionError('could not log in again for serial commands')
+        if results is None:
+            results = await self.run_serial()
+
+        # Command errors are swallowed above, so detect a dropped connection before
+        # blaming the empty results on the individual commands
+        if self.reader.at_eof():
+            raise ConnectionResetError('connection closed by device')
+
+        values, failed = self.apply(results)
+
+        # Gauges keep their last value, so only readings that changed need publishing
+        changed = {key: value for key, value in values.items() if self.last_values.get(key) != value}
+        self.last_values.update(changed)
+        if changed or failed:
+            # Publish all readings together once the device has answered every command
+            with _SNAPSHOT_LOCK:
+                _SNAPSHOT.update(changed)
+                for key in failed:
+                    _COMMAND_ERRORS[key] = _COMMAND_ERRORS.get(key, 0) + 1
+
+    async def collect(self, deadline):
+        """Log in if needed and poll the device before the deadline, returning whether it succeeded"""
+        reused = self.writer is not None and not self.reader.at_eof()
+        if not await self.ensure_connected():
+            return False
+
+        try:
+            await self.poll(deadline)
+        except ConnectionResetError:
+            # The logout of an idle session may only show up once we read from it
+            if not reused:
+                raise
+            logger.info("Session to %s was closed by the device, reconnecting", self.hostname)
+            self.close()
+            if not await self.ensure_connected():
+                return False
+            await self.poll(deadline)
+        return True
+
+    def apply(self, results):
+        """Parse the command results into snapshot readings and a list of failed commands"""
+        values = {}
+        failed = []
+        for (key, pattern, convert), result in zip(self.steps, results):
+            logger.debug("Command result: %.200s...", result)
+
+            # Don't parse timeouts or error messages, they carry no reading
+            if not result or _ERROR_RESPONSE_RE.search(result):
+                logger.debug("No usable result for %s on %s", key[0], self.hostname)
+                failed.append(key)
+                continue
 
-        for command, gauge in commands.items():
-            print(f"Executing command on {hostname}: {command}")
-            result = await execute_telnet_command(reader, writer, command)
-            print(f"Command result: {result[:200]}...")
-
-            if command in ['diag pon get transceiver rx-power', 'diag pon get transceiver tx-power']:
-                value = re.search(r'(-?\d+\.\d+)', result)
-                if value:
-                    gauge.labels(ip=hostname).set(float(value.group(0)))
-                    print(f"Set {command} = {value.group(0)}")
-            elif command.startswith('diag gpon get onu-state'):
-                state_code = re.search(r'ONU state: (.*)', result)
-                if state_code:
-                    gauge.labels(ip=hostname).set(onu_state_mapping.get(state_code.group(1), 0))
-                    print(f"Set ONU state = {state_code.group(1)}")
-            else:
-                value = re.search(r'(\d+\.\d+)', result)
-                if value:
-                    gauge.labels(ip=hostname).set(float(value.group(0)))
-                    print(f"Set {command} = {value.group(0)}")
-
-        # Close connection
-        writer.close()
-        await writer.wait_closed()
-        print(f"Successfully collected metrics from {hostname}")
-
-    except asyncio.TimeoutError:
-        print(f"Timeout connecting to {hostname}:{port}")
-    except Exception as e:
-        print(f"Error connecting to {hostname}:{port} - {e}")
+            match = pattern.search(result)
+            value = convert(match.group(1)) if match else None
+            if value is not None:
+                values[key] = value
+                logger.debug("Parsed %s = %s", key[0], match.group(1))
+        return values, failed
 
+    def close(self):
+        """Drop the session so the next poll reconnects"""
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
 
-def fetch_and_update_metrics_via_telnet_sync(hostname, port, username, password):
-    """Synchronous wrapper for the async telnet function"""
-    try:
-        asyncio.run(fetch_and_update_metrics_via_telnet(hostname, port, username, password))
-    except Exception as e:
-        print(f"Error in telnet sync wrapper for {hostname}: {e}")
 
+device_sessions = {}
 
-def main():
+# Caps how many devices are polled at once so large fleets don't exhaust sockets
+device_semaphore = asyncio.Semaphore(args.max_concurrent)
+
+# Overall time one device may take: connecting, the three login waits and every
+# command, capped below the fetch interval so a dead device can't hold up the round
+device_budget = min(4 * args.connect_timeout + len(commands) * args.command_timeout,
+                    args.fetch_interval * 0.8)
+
+
+def record_collection(hostname, duration, succeeded):
+    """Publish how long a device collection took and whether it failed"""
+    with _SNAPSHOT_LOCK:
+        _COLLECTION_DURATIONS[hostname] = duration
+        if not succeeded:
+            _COLLECTION_ERRORS[hostname] += 1
+
+
+async def fetch_and_update_metrics_via_telnet(hostname, port, username, password):
+    """Fetch metrics over a persistent telnet session, reconnecting on error"""
+    session = device_sessions.get(hostname)
+    if session is None:
+        session = device_sessions[hostname] = DeviceSession(hostname, port, username, password)
+
+    async with device_semaphore:
+        start = time.monotonic()
+        succeeded = False
+        try:
+            deadline = asyncio.get_running_loop().time() + device_budget
+            succeeded = await asyncio.wait_for(session.collect(deadline), timeout=device_budget)
+            if succeeded:
+                logger.info("Successfully collected metrics from %s", hostname)
+
+        except asyncio.TimeoutError:
+            logger.warning("Timeout collecting metrics from %s:%s", hostname, port)
+            session.close()
+        except Exception as e:
+            logger.error("Error collecting metrics from %s:%s - %s", hostname, port, e)
+            session.close()
+
+        record_collection(hostname, time.monotonic() - start, succeeded)
+
+
+async def run_once():
+    """Poll all configured devices concurrently"""
+    coros = [
+        fetch_and_update_metrics_via_telnet(hostname, port, user, password)
+        for hostname, port, user, password in zip(args.hostname, args.port, args.user, args.password)
+    ]
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for hostname, result in zip(args.hostname, results):
+        if isinstance(result, Exception):
+            logger.error("Error collecting metrics from %s: %s", hostname, result)
+
+
+async def main_async():
     start_http_server(args.webserver_port)
-    print(f"Started Prometheus metrics server on port {args.webserver_port}")
-    print(f"Monitoring {len(args.hostname)} GPON devices")
+    logger.info("Started Prometheus metrics server on port %s", args.webserver_port)
+    logger.info("Monitoring %d GPON devices", len(args.hostname))
 
+    # Schedule rounds against a monotonic deadline so collection time doesn't shift the cadence
+    deadline = time.monotonic()
     while True:
-        for i in range(len(args.hostname)):
-            print(f"Fetching metrics from {args.hostname[i]}:{args.port[i]}")
-            fetch_and_update_metrics_via_telnet_sync(args.hostname[i], args.port[i], args.user[i], args.password[i])
-        print(f"Waiting {args.fetch_interval} seconds before next collection...")
-        time.sleep(args.fetch_interval)
+        logger.debug("Fetching metrics from %d devices", len(args.hostname))
+        await run_once()
+
+        deadline += args.fetch_interval
+        delay = deadline - time.monotonic()
+        if delay < 0:
+            logger.warning("Collection overran the %s second fetch interval by %.1f seconds",
+                           args.fetch_interval, -delay)
+            deadline = time.monotonic()
+            delay = 0
+        logger.debug("Waiting %.1f seconds before next collection...", delay)
+        await asyncio.sleep(delay)
+
+
+def main():
+    asyncio.run(main_async())
 
 
 if __name__ == "__main__":